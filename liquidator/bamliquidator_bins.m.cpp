@@ -1,9 +1,11 @@
 #include "bamliquidator.h"
+#include "hdf5_util.h"
 #include "liquidator_util.h"
 
 #include <cmath>
 #include <fstream>
 #include <iostream>
+#include <limits>
 #include <sstream>
 #include <stdexcept>
 #include <string>
@@ -29,7 +31,7 @@ struct CountH5Record
   uint32_t bin_number;
   char cell_type[16];
   char chromosome[64];
-  uint64_t count;
+  uint32_t count; // the number of read base pairs in the bin, which is saturated at the uint32_t max
   uint32_t bam_file_key;
 };
 
@@ -141,11 +143,21 @@ void liquidate_bins(std::vector<CountH5Record>& counts, const std::string& bam_f
     {
       const size_t start = counts[i].bin_number * bin_size;
       const size_t stop = start + bin_size;
-      counts[i].count = liquidator.liquidate(counts[i].chromosome,
-                                              start, 
-                                              stop, 
-                                              strand,
-                                              extension);
+      const double count = liquidator.liquidate(counts[i].chromosome,
+                                                start, 
+                                                stop, 
+                                                strand,
+                                                extension);
+      if (count > std::numeric_limits<uint32_t>::max())
+      {
+        Logger::warn() << counts[i].chromosome << " bin " << counts[i].bin_number << " count " << count
+                       << " is too large, so it is saturated at " << std::numeric_limits<uint32_t>::max();
+        counts[i].count = std::numeric_limits<uint32_t>::max();
+      }
+      else
+      {
+        counts[i].count = count;
+      }
     } catch(const std::exception& e)
     {
       Logger::warn() << "Skipping " << counts[i].chromosome
@@ -211,12 +223,14 @@ int main(int argc, char* argv[])
 {
   try
   {
-    if (argc < 13 || argc % 2 != 1)
+    if (argc != 12 && (argc < 13 || argc % 2 != 1))
     {
       std::cerr << "usage: " << argv[0] 
         << " number_of_threads cell_type bin_size extension strand bam_file bam_file_key hdf5_file log_file write_warnings_to_stderr chr1 length1 ... \n"
         << "\ne.g. " << argv[0] << " mm1s 100000 0 . /ifs/hg18/mm1s/04032013_D1L57ACXX_4.TTAGGC.hg18.bwt.sorted.bam "
         << "137 counts.hdf5 output/log.txt 1 chr1 247249719 chr2 242951149 chr3 199501827"
+        << "\nthe chromosome length pairs may instead be a single path to a file with a tab separated chromosome and "
+        << "\nlength on each line."
         << "\nnumber of threads <= 0 means use a number of threads equal to the number of logical cpus."
         << "\nnote that this application is intended to be run from bamliquidator_batch.py -- see"
         << "\nhttps://github.com/BradnerLab/pipeline/wiki for more information"
@@ -248,8 +262,8 @@ int main(int argc, char* argv[])
       return 2;
     }
 
-    hid_t h5file = H5Fopen(hdf5_file_path.c_str(), H5F_ACC_RDWR, H5P_DEFAULT);
-    if (h5file < 0)
+    ScopedH5File h5file(H5Fopen(hdf5_file_path.c_str(), H5F_ACC_RDWR, H5P_DEFAULT));
+    if (h5file.get() < 0)
     {
       Logger::error() << "Failed to open H5 file " << hdf5_file_path;
       return 3;
@@ -257,9 +271,7 @@ int main(int argc, char* argv[])
 
     std::vector<CountH5Record> counts = count_placeholders(chromosome_lengths, cell_type, bam_file_key, bin_size);
     batch_liquidate(counts, bin_size, extension, strand, bam_file_path);
-    write(h5file, counts);
-
-    H5Fclose(h5file);
+    write(h5file.get(), counts);
 
     return 0;
   }
@@ -1,4 +1,5 @@
 #include "bamliquidator.h"
+#include "hdf5_util.h"
 #include "liquidator_util.h"
 #include "bamliquidator_regions.h"
 
@@ -136,7 +137,7 @@ int main(int argc, char* argv[])
 {
   try
   {
-    if (argc < 13 || argc % 2 != 1)
+    if (argc != 12 && (argc < 13 || argc % 2 != 1))
     {
       std::cerr << "usage: " << argv[0] << " number_of_threads region_file gff_or_bed_format extension bam_file bam_file_key hdf5_file "
                 << "log_file write_warnings_to_stderr strand chr1 length1 ...\n"
@@ -144,6 +145,8 @@ int main(int argc, char* argv[])
         << "\n      /ifs/labs/bradner/bam/hg18/mm1s/04032013_D1L57ACXX_4.TTAGGC.hg18.bwt.sorted.bam 137 counts.hdf5 "
         << "\n      output/log.txt 1 _ chr1 247249719 chr2 242951149 chr3 199501827\n"
         << "\nstrand value of _ means use strand that is specified in region file (and use . if strand not specified in region file)."
+        << "\nthe chromosome length pairs may instead be a single path to a file with a tab separated chromosome and "
+        << "\nlength on each line."
         << "\nnumber of threads <= 0 means use a number of threads equal to the number of logical cpus."
         << "\nnote that this application is intended to be run from bamliquidator_batch.py -- see"
         << "\nhttps://github.com/BradnerLab/pipeline/wiki for more information"
@@ -169,8 +172,8 @@ int main(int argc, char* argv[])
 
     Logger::configure(log_file_path, write_warnings_to_stderr);
 
-    hid_t h5file = H5Fopen(hdf5_file_path.c_str(), H5F_ACC_RDWR, H5P_DEFAULT);
-    if (h5file < 0)
+    ScopedH5File h5file(H5Fopen(hdf5_file_path.c_str(), H5F_ACC_RDWR, H5P_DEFAULT));
+    if (h5file.get() < 0)
     {
       Logger::error() << "Failed to open H5 file " << hdf5_file_path;
       return 3;
@@ -201,9 +204,7 @@ int main(int argc, char* argv[])
       return 0;
     }
 
-    liquidate_and_write(h5file, regions, extension, bam_file_path);
-   
-    H5Fclose(h5file);
+    liquidate_and_write(h5file.get(), regions, extension, bam_file_path);
 
     return 0;
   }
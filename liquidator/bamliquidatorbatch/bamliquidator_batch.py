@@ -6,24 +6,57 @@ from flattener import write_tab_for_all
 from total_mapped_reads import total_mapped_reads
 
 import argparse
+import contextlib
 import datetime
 import os
+import re
+import shutil
 import subprocess
 import tables
 import logging
 import sys
+import tempfile
 import abc
 import collections
+import multiprocessing
 import numpy
 
-from time import time 
+from multiprocessing.pool import ThreadPool
+try:
+    from time import monotonic as time # durations shouldn't be affected by system clock changes
+except ImportError:
+    from time import time # python 2 has no monotonic clock in the standard library
 from os.path import basename
 from os.path import dirname
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # backport of os.scandir for python 2
+    except ImportError:
+        scandir = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 __version__ = util.version
 
 default_black_list = ["chrUn", "_random", "Zv9_", "_hap"]
 
+max_bin_count = numpy.iinfo(numpy.uint32).max # see BinLiquidator.create_counts_table
+
+# Counts tables can have many millions of rows, so they are compressed and use chunks of about 256 KiB.
+# zlib is used instead of blosc since the bamliquidator_bins/bamliquidator_regions executables append to
+# these tables with the standard hdf5 library, which includes zlib (and shuffle) but not blosc.
+counts_table_filters = tables.Filters(complevel=1, complib="zlib", shuffle=True)
+
+def counts_table_chunkshape(description, chunk_size = 256*1024):
+    row_size = tables.Description(description().columns)._v_itemsize
+    return (max(1, chunk_size // row_size),)
+
 def create_files_table(h5file):
     class Files(tables.IsDescription):
         key       = tables.UInt32Col(    pos=0) # is there an easier way to assign keys?
@@ -33,6 +66,7 @@ def create_files_table(h5file):
 
     table = h5file.create_table("/", "files", Files, "File keys and reference sequence lengths corresponding "
                                                      "to the counts table")
+    table.attrs.next_key = 1 # see preprocess
     table.flush()
 
     return table
@@ -47,29 +81,64 @@ def create_file_names_array(h5file):
     return array
 
 def all_bam_file_paths_in_directory(bam_directory):
+    if scandir is None:
+        bam_file_paths = []
+        for dirpath, _, files in os.walk(bam_directory, followlinks=True):
+            for file_ in files:
+                if file_.endswith(".bam"):
+                    bam_file_paths.append(os.path.join(dirpath, file_))
+        return bam_file_paths
+
+    # scandir usually avoids a stat call for each directory entry (which os.walk does on python 2), so this
+    # is faster for large directory trees.  Directories are visited in the same order as os.walk, except that
+    # a directory is not descended into again from within itself in case symbolic links form a loop.  Only
+    # symbolic links need a stat call to identify the directory they point to, since any loop goes through one;
+    # other directories are identified by their inode from the listing and the device of their parent.
+    try:
+        stat = os.stat(bam_directory)
+    except OSError:
+        return [] # like os.walk
     bam_file_paths = []
-    for dirpath, _, files in os.walk(bam_directory, followlinks=True):
-        for file_ in files:
-            if file_.endswith(".bam"):
-                bam_file_paths.append(os.path.join(dirpath, file_))
+    directories = [(bam_directory, stat.st_dev, frozenset([(stat.st_dev, stat.st_ino)]))]
+    while directories:
+        directory, device, ancestors = directories.pop()
+
+        subdirectories = []
+        try:
+            for entry in scandir(directory):
+                if entry.is_dir():
+                    if entry.is_symlink():
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        directory_id = (stat.st_dev, stat.st_ino)
+                    else:
+                        directory_id = (device, entry.inode())
+                    if directory_id not in ancestors:
+                        subdirectories.append((entry.path, directory_id[0], ancestors | set([directory_id])))
+                elif entry.name.endswith(".bam"):
+                    bam_file_paths.append(entry.path)
+        except OSError:
+            continue # os.walk also skips directories that can't be listed
+        directories.extend(reversed(subdirectories))
     return bam_file_paths
 
 def bam_file_paths_with_no_file_entries(file_names, bam_file_paths):
-    with_no_counts = []
-
-    for bam_file_path in bam_file_paths:
-        if basename(bam_file_path) not in file_names:
-            with_no_counts.append(bam_file_path)
+    # read all the file names once, since each "in" check on the vlarray itself reads every entry
+    existing_file_names = set(file_names[:])
 
-    return with_no_counts
+    return [bam_file_path for bam_file_path in bam_file_paths
+            if basename(bam_file_path) not in existing_file_names]
 
 # BaseLiquidator is an abstract base class, with concrete classes BinLiquidator and RegionLiquidator
 # that implement the abstract methods.
 class BaseLiquidator(object):
     __metaclass__ = abc.ABCMeta
 
+    # counts_file_path defaults to self.counts_file_path
     @abc.abstractmethod
-    def liquidate(self, bam_file_path, extension, sense = None):
+    def liquidate(self, bam_file_path, extension, sense = None, counts_file_path = None):
         pass
 
     @abc.abstractmethod
@@ -81,16 +150,19 @@ class BaseLiquidator(object):
         pass
 
     def __init__(self, executable, counts_table_name, output_directory, bam_file_path,
-                 include_cpp_warnings_in_stderr = True, counts_file_path = None, number_of_threads = 0):
+                 include_cpp_warnings_in_stderr = True, counts_file_path = None, number_of_threads = 0,
+                 number_of_jobs = 1):
         # clear all memoized values from any prior runs
         nps.file_keys_memo = {}
 
         self.timings = collections.OrderedDict()
 
         self.output_directory = output_directory
+        self.counts_table_name = counts_table_name
         self.counts_file_path = counts_file_path
         self.include_cpp_warnings_in_stderr = include_cpp_warnings_in_stderr
         self.number_of_threads = number_of_threads
+        self.number_of_jobs = number_of_jobs
         self.chromosome_patterns_to_skip = [] 
 
         self.executable_path = util.most_appropriate_executable_path(executable)
@@ -114,6 +186,8 @@ class BaseLiquidator(object):
             files = create_files_table(counts_file)
             file_names = create_file_names_array(counts_file)
 
+        self.migrate_counts_table(counts_file, counts)
+
         if os.path.isdir(bam_file_path):
             self.bam_file_paths = all_bam_file_paths_in_directory(bam_file_path)
         else:
@@ -140,20 +214,25 @@ class BaseLiquidator(object):
         # key 0 is special and denotes "no specific file", which
         # is used in normalizated_counts tables to mean an average or total for all bam files
         # of a specific cell type.
-        next_file_key = 0 # see += 1 below
-        for file_record in files:
-            next_file_key = max(next_file_key, file_record["key"])
-        next_file_key += 1
+        if "next_key" in files.attrs:
+            next_file_key = int(files.attrs.next_key)
+        else:
+            # files tables from versions before the next_key attribute was added
+            next_file_key = 0 # see += 1 below
+            for file_record in files:
+                next_file_key = max(next_file_key, file_record["key"])
+            next_file_key += 1
+
+        # rows are collected and appended all at once, rather than a row at a time
+        file_rows = []
+        new_file_names = []
 
-        for bam_file_path in self.bam_file_paths:
+        for bam_file_path, (file_count, chromosome_length_pairs) in zip(self.bam_file_paths,
+                                                                       self.all_total_mapped_reads()):
             file_name = os.path.basename(bam_file_path)
 
-            file_count, chromosome_length_pairs = total_mapped_reads(bam_file_path, util.chromosome_name_length)
-                        
-            files.row["key"] = next_file_key
-            files.row["length"] = file_count
-            files.row.append()
-            file_names.append(file_name)
+            file_rows.append((next_file_key, file_count))
+            new_file_names.append(file_name)
 
             self.file_to_chromosome_length_pairs[file_name] = chromosome_length_pairs
             self.file_to_count[file_name] = file_count
@@ -161,18 +240,43 @@ class BaseLiquidator(object):
 
             next_file_key += 1
 
+        if file_rows:
+            files.append(numpy.array(file_rows, dtype=files.dtype))
+        for file_name in new_file_names:
+            file_names.append(file_name)
+
+        files.attrs.next_key = next_file_key
         files.flush()
         file_names.flush()
         assert(len(file_names) - 1 == len(files))
         assert(len(file_names) == next_file_key)
 
-    def batch(self, extension, sense):
-        for i, bam_file_path in enumerate(self.bam_file_paths):
-            logging.info("Liquidating %s (file %d of %d)", bam_file_path, i+1, len(self.bam_file_paths))
+    # samtools idxstats is called for each bam file concurrently, since each call mostly waits on its own file,
+    # returning the (total mapped read count, chromosome length pairs) in the same order as self.bam_file_paths
+    def all_total_mapped_reads(self):
+        if not self.bam_file_paths:
+            return []
+
+        number_of_threads = self.number_of_threads if self.number_of_threads > 0 else multiprocessing.cpu_count()
+        pool = ThreadPool(min(number_of_threads, len(self.bam_file_paths)))
+        try:
+            results = pool.map(lambda bam_file_path: total_mapped_reads(bam_file_path, util.chromosome_name_length),
+                               self.bam_file_paths)
+            pool.close()
+            return results
+        except:
+            pool.terminate() # don't leave workers running the remaining calls
+            raise
+        finally:
+            pool.join()
 
-            return_code = self.liquidate(bam_file_path, extension, sense)
-            if return_code != 0:
-                raise Exception("%s failed with exit code %d" % (self.executable_path, return_code))
+    def batch(self, extension, sense):
+        number_of_jobs = self.number_of_concurrent_liquidations()
+        if number_of_jobs > 1:
+            self.liquidate_concurrently(number_of_jobs, extension, sense)
+        else:
+            for i, bam_file_path in enumerate(self.bam_file_paths):
+                self.liquidate_and_check(i, bam_file_path, extension, sense)
 
         start = time()
         self.normalize()
@@ -180,6 +284,61 @@ class BaseLiquidator(object):
         logging.info("Post liquidation processing took %f seconds", duration)
         self.log_time('post_liquidation', duration)
 
+    # Up to number_of_jobs bam files are liquidated at the same time, each with number_of_threads threads
+    def number_of_concurrent_liquidations(self):
+        return max(1, min(self.number_of_jobs, len(self.bam_file_paths)))
+
+    # Counts tables from earlier versions may have a different description than create_counts_table, in which
+    # case this converts them so that the executable can append to them.  Nothing needs converting by default.
+    def migrate_counts_table(self, h5file, counts):
+        pass
+
+    def liquidate_and_check(self, i, bam_file_path, extension, sense, counts_file_path = None):
+        logging.info("Liquidating %s (file %d of %d)", bam_file_path, i+1, len(self.bam_file_paths))
+
+        return_code = self.liquidate(bam_file_path, extension, sense, counts_file_path)
+        if return_code != 0:
+            raise Exception("%s failed with exit code %d" % (self.executable_path, return_code))
+
+    # HDF5 files don't support concurrent writers, so each concurrent liquidation writes to its own counts
+    # file, and these are then appended to the counts file in bam file order (matching serial liquidation).
+    def liquidate_concurrently(self, number_of_jobs, extension, sense):
+        private_directory = tempfile.mkdtemp(prefix='liquidation_', dir=self.output_directory)
+        try:
+            private_counts_file_paths = []
+            for i in range(len(self.bam_file_paths)):
+                private_counts_file_path = os.path.join(private_directory, "counts_%d.h5" % i)
+                with tables.open_file(private_counts_file_path, mode = "w") as private_counts_file:
+                    self.create_counts_table(private_counts_file)
+                private_counts_file_paths.append(private_counts_file_path)
+
+            def liquidate_into_private_counts_file(i):
+                self.liquidate_and_check(i, self.bam_file_paths[i], extension, sense, private_counts_file_paths[i])
+
+            pool = ThreadPool(number_of_jobs)
+            try:
+                pool.map(liquidate_into_private_counts_file, range(len(self.bam_file_paths)))
+                pool.close()
+            except:
+                pool.terminate() # don't start liquidating the remaining bam files
+                raise
+            finally:
+                pool.join()
+
+            self.append_counts(private_counts_file_paths)
+        finally:
+            shutil.rmtree(private_directory)
+
+    def append_counts(self, private_counts_file_paths, rows_per_read = 100000):
+        with tables.open_file(self.counts_file_path, mode = "r+") as counts_file:
+            counts = counts_file.get_node("/", self.counts_table_name)
+            for private_counts_file_path in private_counts_file_paths:
+                with tables.open_file(private_counts_file_path, mode = "r") as private_counts_file:
+                    private_counts = private_counts_file.get_node("/", self.counts_table_name)
+                    for start in xrange(0, private_counts.nrows, rows_per_read):
+                        counts.append(private_counts.read(start, start + rows_per_read))
+            counts.flush()
+
     def flatten(self):
         logging.info("Flattening HDF5 tables into text files")
         start = time()
@@ -191,15 +350,37 @@ class BaseLiquidator(object):
         logging.info("Flattening took %f seconds" % duration)
         self.log_time('flattening', duration)
 
-    def chromosome_args(self, bam_file_name, skip_non_canonical):
-        args = []
-        for chromosome, length in self.file_to_chromosome_length_pairs[bam_file_name]:
-            if skip_non_canonical:
-                if any(pattern in chromosome for pattern in self.chromosome_patterns_to_skip):
-                    continue
-            args.append(chromosome)
-            args.append(str(length))
-        return args
+    @property
+    def chromosome_patterns_to_skip(self):
+        return self._chromosome_patterns_to_skip
+
+    # a single regex matching any of the patterns is faster than checking each pattern separately, and it is
+    # compiled once here rather than for each bam file
+    @chromosome_patterns_to_skip.setter
+    def chromosome_patterns_to_skip(self, patterns):
+        self._chromosome_patterns_to_skip = patterns
+        self.chromosome_skip_regex = None
+        if patterns:
+            self.chromosome_skip_regex = re.compile("|".join(re.escape(pattern) for pattern in patterns))
+
+    def chromosome_length_pairs_to_liquidate(self, bam_file_name, skip_non_canonical):
+        skip_regex = self.chromosome_skip_regex if skip_non_canonical else None
+        return [(chromosome, length) for chromosome, length in self.file_to_chromosome_length_pairs[bam_file_name]
+                if skip_regex is None or not skip_regex.search(chromosome)]
+
+    # Writes the chromosomes to liquidate to a temporary tab separated chromosome/length file and yields its path,
+    # which the executable takes in place of chromosome/length argument pairs.  This keeps the argv small even
+    # for references with many contigs.
+    @contextlib.contextmanager
+    def chromosome_lengths_file(self, bam_file_name, skip_non_canonical):
+        with tempfile.NamedTemporaryFile(mode='w', prefix='chromosome_lengths_', suffix='.txt',
+                                         dir=self.output_directory, delete=False) as lengths_file:
+            for chromosome, length in self.chromosome_length_pairs_to_liquidate(bam_file_name, skip_non_canonical):
+                lengths_file.write("%s\t%d\n" % (chromosome, length))
+        try:
+            yield lengths_file.name
+        finally:
+            os.remove(lengths_file.name)
         
     def logging_cpp_args(self):
         return [os.path.join(self.output_directory, "log.txt"), "1" if self.include_cpp_warnings_in_stderr else "0"]
@@ -217,33 +398,40 @@ class BaseLiquidator(object):
 class BinLiquidator(BaseLiquidator):
     def __init__(self, bin_size, output_directory, bam_file_path,
                  counts_file_path = None, extension = 0, sense = '.', skip_plot = False,
-                 include_cpp_warnings_in_stderr = True, number_of_threads = 0, blacklist = default_black_list):
+                 include_cpp_warnings_in_stderr = True, number_of_threads = 0, blacklist = default_black_list,
+                 number_of_jobs = 1):
         self.bin_size = bin_size
         self.skip_plot = skip_plot
         super(BinLiquidator, self).__init__("bamliquidator_bins", "bin_counts", output_directory, bam_file_path,
-                                            include_cpp_warnings_in_stderr, counts_file_path, number_of_threads)
+                                            include_cpp_warnings_in_stderr, counts_file_path, number_of_threads,
+                                            number_of_jobs)
         self.chromosome_patterns_to_skip = blacklist
         self.batch(extension, sense)
 
-    def liquidate(self, bam_file_path, extension, sense = None):
+    def liquidate(self, bam_file_path, extension, sense = None, counts_file_path = None):
         if sense is None: sense = '.'
+        if counts_file_path is None: counts_file_path = self.counts_file_path
 
         cell_type = basename(dirname(bam_file_path))
         if cell_type == '':
             cell_type = '-'
         bam_file_name = basename(bam_file_path)
         args = [self.executable_path, str(self.number_of_threads), cell_type, str(self.bin_size), str(extension), sense, bam_file_path, 
-                str(self.file_to_key[bam_file_name]), self.counts_file_path]
+                str(self.file_to_key[bam_file_name]), counts_file_path]
         args.extend(self.logging_cpp_args())
-        args.extend(self.chromosome_args(bam_file_name, skip_non_canonical=True))
 
-        start = time()
-        return_code = subprocess.call(args)
-        duration = time() - start
+        with self.chromosome_lengths_file(bam_file_name, skip_non_canonical=True) as chromosome_lengths_file_path:
+            args.append(chromosome_lengths_file_path)
+            start = time()
+            return_code = subprocess.call(args)
+            duration = time() - start
 
-        reads = self.file_to_count[bam_file_name]
-        rate = reads / (10**6) / duration
-        logging.info("Liquidation completed: %f seconds, %d reads, %f millions of reads per second", duration, reads, rate)
+        # the rate is only calculated when it will be logged, since liquidating a small bam file can be quick
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            reads = self.file_to_count[bam_file_name]
+            rate = reads / (10**6) / duration
+            logging.info("Liquidation completed: %f seconds, %d reads, %f millions of reads per second",
+                         duration, reads, rate)
         self.log_time('liquidation', duration)
 
         return return_code
@@ -252,22 +440,45 @@ class BinLiquidator(BaseLiquidator):
         with tables.open_file(self.counts_file_path, mode = "r+") as counts_file:
             nps.normalize_plot_and_summarize(counts_file, self.output_directory, self.bin_size, self.skip_plot) 
 
+    # bin_counts tables from versions before count was 32 bit are copied to a table with the current description,
+    # provided every count fits
+    def migrate_counts_table(self, h5file, counts, rows_per_read = 100000):
+        if counts.coldtypes["count"] == numpy.uint32:
+            return
+
+        for start in xrange(0, len(counts), rows_per_read):
+            if counts.read(start, start + rows_per_read, field="count").max() > max_bin_count:
+                raise RuntimeError("%s has a bin count larger than %d, so it can't be appended to by this version"
+                                   % (self.counts_file_path, max_bin_count))
+
+        logging.info("Migrating bin_counts table to 32 bit counts")
+        h5file.rename_node(counts, "bin_counts_before_migration")
+        migrated = self.create_counts_table(h5file)
+        for start in xrange(0, len(counts), rows_per_read):
+            migrated.append(counts.read(start, start + rows_per_read).astype(migrated.dtype))
+        migrated.flush()
+        counts.remove()
+
     def create_counts_table(self, h5file):
+        # count is the number of read base pairs in the bin, so 32 bits is enough for bins averaging up to
+        # max_bin_count / bin_size coverage (e.g. about 42,000x for 100,000 base pair bins).  bamliquidator_bins
+        # saturates larger counts at max_bin_count (and warns).
         class BinCount(tables.IsDescription):
             bin_number = tables.UInt32Col(    pos=0)
             cell_type  = tables.StringCol(16, pos=1)
             chromosome = tables.StringCol(util.chromosome_name_length, pos=2)
-            count      = tables.UInt64Col(    pos=3)
+            count      = tables.UInt32Col(    pos=3)
             file_key   = tables.UInt32Col(    pos=4)
 
-        table = h5file.create_table("/", "bin_counts", BinCount, "bin counts")
+        table = h5file.create_table("/", "bin_counts", BinCount, "bin counts",
+                                    filters=counts_table_filters, chunkshape=counts_table_chunkshape(BinCount))
         table.flush()
         return table
 
 class RegionLiquidator(BaseLiquidator):
     def __init__(self, regions_file, output_directory, bam_file_path,
                  region_format=None, counts_file_path = None, extension = 0, sense = '.',
-                 include_cpp_warnings_in_stderr = True, number_of_threads = 0):
+                 include_cpp_warnings_in_stderr = True, number_of_threads = 0, number_of_jobs = 1):
         self.regions_file = regions_file
         self.region_format = region_format
         if self.region_format is None:
@@ -279,24 +490,27 @@ class RegionLiquidator(BaseLiquidator):
                                % str(self.region_format))
 
         super(RegionLiquidator, self).__init__("bamliquidator_regions", "region_counts", output_directory, 
-                                               bam_file_path, include_cpp_warnings_in_stderr, counts_file_path, number_of_threads)
+                                               bam_file_path, include_cpp_warnings_in_stderr, counts_file_path, number_of_threads,
+                                               number_of_jobs)
         
         self.batch(extension, sense)
 
-    def liquidate(self, bam_file_path, extension, sense = None):
+    def liquidate(self, bam_file_path, extension, sense = None, counts_file_path = None):
+        if counts_file_path is None: counts_file_path = self.counts_file_path
         bam_file_name = basename(bam_file_path)
         args = [self.executable_path, str(self.number_of_threads), self.regions_file, str(self.region_format), str(extension), bam_file_path, 
-                str(self.file_to_key[bam_file_name]), self.counts_file_path]
+                str(self.file_to_key[bam_file_name]), counts_file_path]
         args.extend(self.logging_cpp_args())
         if sense is None:
             args.append('_') # _ means use strand specified in region file (or . if none specified)
         else:
             args.append(sense)
-        args.extend(self.chromosome_args(bam_file_name, skip_non_canonical=False))
 
-        start = time()
-        return_code = subprocess.call(args)
-        duration = time() - start
+        with self.chromosome_lengths_file(bam_file_name, skip_non_canonical=False) as chromosome_lengths_file_path:
+            args.append(chromosome_lengths_file_path)
+            start = time()
+            return_code = subprocess.call(args)
+            duration = time() - start
 
         logging.info("Liquidation completed: %f seconds", duration)
         self.log_time('liquidation', duration)
@@ -318,40 +532,111 @@ class RegionLiquidator(BaseLiquidator):
             count            = tables.UInt64Col(    pos=6)
             normalized_count = tables.Float64Col(   pos=7)
 
-        table = h5file.create_table("/", "region_counts", Region, "region counts")
+        table = h5file.create_table("/", "region_counts", Region, "region counts",
+                                    filters=counts_table_filters, chunkshape=counts_table_chunkshape(Region))
         table.flush()
         return table
 
-def write_bamToGff_matrix(output_file_path, h5_region_counts_file_path):
+if njit is not None:
+    @njit(cache=True)
+    def scatter_counts(file_key_column, count_column, key_to_column, counts):
+        next_row = numpy.zeros(counts.shape[1], dtype=numpy.int64)
+        for i in range(file_key_column.shape[0]):
+            file_key = file_key_column[i]
+            if file_key >= key_to_column.shape[0] or key_to_column[file_key] < 0:
+                raise ValueError("region counts file key is missing from the files table")
+            column = key_to_column[file_key]
+            if next_row[column] >= counts.shape[0]:
+                raise ValueError("a file has more region counts than expected")
+            counts[next_row[column], column] = count_column[i]
+            next_row[column] += 1
+
+# Returns a (number_of_regions, len(file_keys)) array of the counts, with a column for each file key in the
+# given order.  Every file has the exact same regions in the same order, so a file's nth row is the nth region.
+def counts_by_region_and_file(file_key_column, count_column, file_keys, number_of_regions):
+    number_of_files = len(file_keys)
+    if len(count_column) != number_of_regions * number_of_files:
+        raise ValueError("each file must have the same number of region counts")
+
+    if njit is not None:
+        # numba compiles a single pass placing each count directly, with no sort
+        max_file_key = max(max(file_keys), file_key_column.max() if len(file_key_column) > 0 else 0)
+        key_to_column = numpy.full(max_file_key + 1, -1, dtype=numpy.int64)
+        key_to_column[list(file_keys)] = numpy.arange(number_of_files)
+        counts = numpy.empty((number_of_regions, number_of_files), dtype=count_column.dtype)
+        scatter_counts(file_key_column, count_column, key_to_column, counts)
+        return counts
+
+    # a stable sort on the file key groups the rows into one contiguous block of regions per file
+    order = numpy.argsort(file_key_column, kind="mergesort")
+    sorted_file_keys = numpy.array(sorted(file_keys))
+    if len(numpy.setdiff1d(file_key_column, sorted_file_keys)) > 0:
+        raise ValueError("region counts file key is missing from the files table")
+    if (file_key_column[order].reshape(number_of_files, number_of_regions) != sorted_file_keys[:, None]).any():
+        raise ValueError("a file has more region counts than expected")
+    counts_by_file = count_column[order].reshape(number_of_files, number_of_regions)
+    key_to_block = dict((file_key, block) for block, file_key in enumerate(sorted_file_keys))
+    return counts_by_file[[key_to_block[file_key] for file_key in file_keys]].T
+
+def write_bamToGff_matrix(output_file_path, h5_region_counts_file_path, rows_per_write = 100000):
     with tables.open_file(h5_region_counts_file_path, "r") as counts_file:
-        with open(output_file_path, "w") as output:
+        with open(output_file_path, "w", 1024*1024) as output:
             file_keys = []
+            file_names = counts_file.root.file_names[:]
 
             output.write("GENE_ID\tlocusLine")
             for file_record in counts_file.root.files:
                 file_key = file_record["key"] 
                 file_keys.append(file_key)
-                output.write("\tbin_1_%s" % counts_file.root.file_names[file_key])
+                output.write("\tbin_1_%s" % file_names[file_key])
             output.write("\n")
 
+            region_counts = counts_file.root.region_counts
             number_of_files = len(file_keys)
-            number_of_regions = counts_file.root.region_counts.nrows / number_of_files 
-
-            # first loop through all but the last file index, storing those counts 
-            prior_region_counts = numpy.zeros((number_of_regions,  number_of_files - 1))
-            for col, file_key in enumerate(file_keys[:-1]):
-                for row, region in enumerate(counts_file.root.region_counts.where("file_key == %d" % file_key)):
-                    prior_region_counts[row, col] = region["normalized_count"]
-
-            # then loop through the last index,
-            # printing the region columns and the counts for the prior files,
-            # along with the count for the last index
-            for row, region in enumerate(counts_file.root.region_counts.where("file_key == %d" % file_keys[-1])):
-                output.write("%s\t%s(%s):%d-%d" % (region["region_name"], region["chromosome"],
-                    region["strand"], region["start"], region["stop"]))
-                for col in range(0, number_of_files-1):
-                    output.write("\t%s" % round(prior_region_counts[row, col], 4))
-                output.write("\t%s\n" % round(region["normalized_count"], 4))
+            number_of_regions = region_counts.nrows // number_of_files
+
+            if number_of_files == 1:
+                # every row is for the single file and already in region order, so nothing needs regrouping
+                region_counts_by_file = region_counts.read(field="normalized_count").reshape(number_of_regions, 1)
+                region_rows = None
+            else:
+                file_key_column = region_counts.read(field="file_key")
+                region_counts_by_file = counts_by_region_and_file(file_key_column,
+                                                                  region_counts.read(field="normalized_count"),
+                                                                  file_keys, number_of_regions)
+
+                # the region columns are taken from the last file's rows
+                region_rows = numpy.flatnonzero(file_key_column == file_keys[-1])
+
+            # only the region rows are read, rather than reading whole columns (for every file) and then indexing
+            def region_column(field):
+                if region_rows is None:
+                    return region_counts.read(field=field)
+                return region_counts.read_coordinates(region_rows, field=field)
+
+            region_names = region_column("region_name")
+            chromosomes = region_column("chromosome")
+            strands = region_column("strand")
+            starts = region_column("start")
+            stops = region_column("stop")
+
+            locus_lines = numpy.char.add(numpy.char.add(numpy.char.add(numpy.char.add(numpy.char.add(numpy.char.add(
+                chromosomes, "("), strands), "):"), starts.astype("S20")), "-"), stops.astype("S20"))
+
+            # print the region columns and the counts for each file.
+            # The counts are formatted with %s after python's round (rather than %.4f) to match bamToGFF_turbo.py,
+            # and are stored as python floats in an object array so that savetxt formats each row at once.
+            # numpy.round isn't used since it rounds halves to even (e.g. 1.03125 to 1.0312 instead of 1.0313).
+            # Each python float takes several times the memory of a float64, so the object array is only
+            # made rows_per_write regions at a time.
+            python_round = numpy.frompyfunc(round, 2, 1)
+            for start in xrange(0, number_of_regions, rows_per_write):
+                stop = min(start + rows_per_write, number_of_regions)
+                matrix = numpy.empty((stop - start, number_of_files + 2), dtype=object)
+                matrix[:, 0] = region_names[start:stop]
+                matrix[:, 1] = locus_lines[start:stop]
+                matrix[:, 2:] = python_round(region_counts_by_file[start:stop], 4)
+                numpy.savetxt(output, matrix, fmt="%s", delimiter="\t")
 
 def main():
     parser = argparse.ArgumentParser(description='Count the number of base pair reads in each bin or region '
@@ -362,7 +647,10 @@ def main():
     mut_exclusive_group = parser.add_mutually_exclusive_group()
     mut_exclusive_group.add_argument('-b', '--bin_size', type=int, default=100000,
                         help="Number of base pairs in each bin -- the smaller the bin size the longer the runtime and "
-                             "the larger the data files (default is 100000)")
+                             "the larger the data files (default is 100000).  Bin counts are 32 bit, so a bin's count (the "
+                             "number of read base pairs in it) is saturated at %d, which is an average coverage of about "
+                             "42,000x for 100000 base pair bins or 4,300x for 1000000 base pair bins (e.g. chrM in ATAC-seq "
+                             "data can exceed this)" % max_bin_count)
     mut_exclusive_group.add_argument('-r', '--regions_file',
                         help='a region file in either .gff or .bed format')
 
@@ -399,6 +687,10 @@ def main():
     parser.add_argument('-n', '--number_of_threads', type=int, default=0,
                         help='Number of threads to run concurrently during liquidation.  Defaults to the total number of logical '
                              'cpus on the system.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of bam files to liquidate concurrently, each using --number_of_threads threads.  Defaults '
+                             'to 1.  Each concurrent liquidation writes to its own temporary counts file in the output '
+                             'directory, which is appended to the counts file afterwards.')
     parser.add_argument('--xml_timings', action='store_true',
                         help='Write performance timings to junit style timings.xml in output folder, which is useful for '
                              'tracking performance over time with automatically generated Jenkins graphs')
@@ -427,7 +719,7 @@ def main():
     if args.regions_file is None:
         liquidator = BinLiquidator(args.bin_size, args.output_directory, args.bam_file_path,
                                    args.counts_file, args.extension, args.sense, args.skip_plot,
-                                   not args.quiet, args.number_of_threads, args.black_list)
+                                   not args.quiet, args.number_of_threads, args.black_list, args.jobs)
     else:
         if args.counts_file:
             raise Exception("Appending to a prior regions counts.h5 file is not supported at this time -- "
@@ -436,7 +728,7 @@ def main():
         ## review matrix output, specifically the assumption that each file has the exact same regions in the same order
         liquidator = RegionLiquidator(args.regions_file, args.output_directory, args.bam_file_path, 
                                       args.region_format, args.counts_file, args.extension, args.sense,
-                                      not args.quiet, args.number_of_threads)
+                                      not args.quiet, args.number_of_threads, args.jobs)
 
     if args.flatten:
         liquidator.flatten()
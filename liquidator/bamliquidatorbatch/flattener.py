@@ -18,7 +18,8 @@ def write_tab(table, file_names, output_directory, log=False):
             if log:
                 print "Writing", tab_file_path
 
-            tab_file = open(tab_file_path, 'wb')
+            # a file is open for every chromosome at once, so this buffer is large but not too large
+            tab_file = open(tab_file_path, 'wb', 256*1024)
             writer = csv.writer(tab_file, delimiter='\t')
             writer.writerow(columns)
             chromosome_to_file_writer_pair[chromosome] = (tab_file, writer)
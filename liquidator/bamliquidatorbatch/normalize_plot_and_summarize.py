@@ -30,6 +30,7 @@ import sys
 import os
 import argparse
 import tables
+import numpy
 import scipy.stats as stats
 import collections
 import logging
@@ -173,16 +174,20 @@ def populate_normalized_counts(normalized_counts, counts, file_key, bin_size, fi
     '''
     factor = (1 / bin_size) * (1 / (total_count / 10**6))
 
-    for count_row in counts.where("file_key == %d" % file_key):
-        normalized_counts.row["bin_number"] = count_row["bin_number"]
-        normalized_counts.row["cell_type"] = count_row["cell_type"] 
-        normalized_counts.row["chromosome"] = count_row["chromosome"] 
-        assert file_key == count_row["file_key"]
-        normalized_counts.row["file_key"] = file_key
-        normalized_counts.row["count"] = count_row["count"] * factor 
-        normalized_counts.row["percentile"] = -1
-        normalized_counts.row.append()
+    # read_where returns all the matching rows as a single array, which lets us calculate and append all of
+    # the normalized counts at once instead of row by row
+    count_rows = counts.read_where("file_key == key", condvars={"key": numpy.uint32(file_key)})
 
+    normalized_rows = numpy.empty(len(count_rows), dtype=normalized_counts.dtype)
+    normalized_rows["bin_number"] = count_rows["bin_number"]
+    normalized_rows["cell_type"] = count_rows["cell_type"]
+    normalized_rows["chromosome"] = count_rows["chromosome"]
+    normalized_rows["file_key"] = file_key
+    normalized_rows["count"] = count_rows["count"] * factor
+    normalized_rows["percentile"] = -1
+
+    if len(normalized_rows) > 0:
+        normalized_counts.append(normalized_rows)
     normalized_counts.flush()
   
 
@@ -8,6 +8,7 @@ from itertools import izip
 import bamliquidator_batch as blb
 import normalize_plot_and_summarize as nps
 
+import numpy
 import os
 import shutil
 import subprocess
@@ -496,6 +497,251 @@ class AppendingTest(TempDirTest):
                 self.assertEqual(str(together_h5.root.normalized_counts[:]), str(appending_h5.root.normalized_counts[:]))
                 self.assertEqual(str(together_h5.root.summary[:]), str(appending_h5.root.summary[:]))
                 self.assertEqual(str(together_h5.root.sorted_summary[:]), str(appending_h5.root.sorted_summary[:]))
+                self.assertEqual(3, together_h5.root.files.attrs.next_key)
+                self.assertEqual(3, appending_h5.root.files.attrs.next_key)
+
+    def testConcurrentBin(self):
+        # liquidating the bam files concurrently should match the default serial liquidation
+        bin_size = len(self.sequence1)
+        serial_dir_path = os.path.join(self.dir_path, 'serial')
+        blb.BinLiquidator(bin_size = bin_size,
+                          output_directory = serial_dir_path,
+                          bam_file_path = self.dir_path)
+
+        concurrent_dir_path = os.path.join(self.dir_path, 'concurrent')
+        liquidator = blb.BinLiquidator(bin_size = bin_size,
+                                       output_directory = concurrent_dir_path,
+                                       bam_file_path = self.dir_path,
+                                       number_of_threads = 1,
+                                       number_of_jobs = 2)
+        self.assertEqual(2, liquidator.number_of_concurrent_liquidations())
+        # the private counts files are removed after being appended
+        self.assertEqual([], [name for name in os.listdir(concurrent_dir_path) if name.startswith('liquidation_')])
+
+        with tables.open_file(os.path.join(serial_dir_path, 'counts.h5')) as serial_h5:
+            with tables.open_file(os.path.join(concurrent_dir_path, 'counts.h5')) as concurrent_h5:
+                self.assertEqual(str(serial_h5.root.files[:]), str(concurrent_h5.root.files[:]))
+                self.assertEqual(str(serial_h5.root.bin_counts[:]), str(concurrent_h5.root.bin_counts[:]))
+                self.assertEqual(str(serial_h5.root.normalized_counts[:]), str(concurrent_h5.root.normalized_counts[:]))
+                self.assertEqual(str(serial_h5.root.summary[:]), str(concurrent_h5.root.summary[:]))
+
+    def testAppendCountsInChunks(self):
+        bam_file_path = create_bam(self.dir_path, ['chr1', 'chr2', 'chr3'], self.sequence1, 'three_chromosomes.bam')
+        liquidator = blb.BinLiquidator(bin_size = len(self.sequence1),
+                                       output_directory = os.path.join(self.dir_path, 'output'),
+                                       bam_file_path = bam_file_path)
+        with tables.open_file(liquidator.counts_file_path) as counts_file:
+            rows = counts_file.root.bin_counts[:]
+        self.assertEqual(3, len(rows))
+
+        private_counts_file_path = os.path.join(self.dir_path, 'private_counts.h5')
+        with tables.open_file(private_counts_file_path, 'w') as private_counts_file:
+            liquidator.create_counts_table(private_counts_file).append(rows)
+
+        # reading 2 rows at a time takes two reads for each private counts file
+        liquidator.append_counts([private_counts_file_path, private_counts_file_path], rows_per_read = 2)
+
+        with tables.open_file(liquidator.counts_file_path) as counts_file:
+            appended_rows = counts_file.root.bin_counts[:]
+        self.assertEqual(9, len(appended_rows))
+        for start in (0, 3, 6):
+            self.assertEqual(str(rows), str(appended_rows[start:start+3]))
+
+    def testAppendingToLegacyBin(self):
+        # appending to a bin_counts table with the older 64 bit count column should migrate it to 32 bit counts
+        bin_size = len(self.sequence1)
+        together_dir_path = os.path.join(self.dir_path, 'together')
+        blb.BinLiquidator(bin_size = bin_size,
+                          output_directory = together_dir_path,
+                          bam_file_path = self.dir_path)
+
+        appending_dir = os.path.join(self.dir_path, 'appending')
+        blb.BinLiquidator(bin_size = bin_size,
+                          output_directory = appending_dir,
+                          bam_file_path = self.bam1_file_path)
+
+        class LegacyBinCount(tables.IsDescription):
+            bin_number = tables.UInt32Col(    pos=0)
+            cell_type  = tables.StringCol(16, pos=1)
+            chromosome = tables.StringCol(blb.util.chromosome_name_length, pos=2)
+            count      = tables.UInt64Col(    pos=3)
+            file_key   = tables.UInt32Col(    pos=4)
+
+        appending_h5_path = os.path.join(appending_dir, 'counts.h5')
+        with tables.open_file(appending_h5_path, 'r+') as appending_h5:
+            rows = appending_h5.root.bin_counts[:]
+            appending_h5.root.bin_counts.remove()
+            legacy_counts = appending_h5.create_table("/", "bin_counts", LegacyBinCount, "bin counts")
+            legacy_counts.append(rows.astype(legacy_counts.dtype))
+
+        blb.BinLiquidator(bin_size = bin_size,
+                          output_directory = os.path.join(self.dir_path, 'appending_extra_without_h5_file'),
+                          bam_file_path = self.bam2_file_path,
+                          counts_file_path = appending_h5_path)
+
+        with tables.open_file(os.path.join(together_dir_path, 'counts.h5')) as together_h5:
+            with tables.open_file(appending_h5_path) as appending_h5:
+                self.assertEqual('uint32', str(appending_h5.root.bin_counts.coldtypes['count']))
+                self.assertFalse('bin_counts_before_migration' in appending_h5.root)
+                self.assertEqual(str(together_h5.root.bin_counts[:]), str(appending_h5.root.bin_counts[:]))
+                self.assertEqual(str(together_h5.root.normalized_counts[:]), str(appending_h5.root.normalized_counts[:]))
+
+class MultipleBamMatrixTest(TempDirTest):
+    def setUp(self):
+        super(MultipleBamMatrixTest, self).setUp()
+        self.sequence = 'ATTTAAAAATTAATTTAATGCTTGGCTAAATCTTAATTACATATATAATT'
+        create_bam(self.dir_path, ['chr1'], self.sequence, 'one_read.bam')
+        create_bam(self.dir_path, ['chr1', 'chr2'], self.sequence, 'two_reads.bam')
+
+    def liquidate_regions(self):
+        regions_file_path = os.path.join(self.dir_path, 'regions.gff')
+        with open(regions_file_path, 'w') as region_file:
+            region_file.write('chr1\tregion_a\t\t1\t8\t\t.\t\tregion_a\n')
+            region_file.write('chr1\tregion_b\t\t11\t30\t\t.\t\tregion_b\n')
+
+        return blb.RegionLiquidator(regions_file = regions_file_path,
+                                    output_directory = os.path.join(self.dir_path, 'output'),
+                                    bam_file_path = self.dir_path)
+
+    def test_region_matrix(self):
+        liquidator = self.liquidate_regions()
+
+        matrix_path = os.path.join(self.dir_path, 'matrix.gff')
+        blb.write_bamToGff_matrix(matrix_path, liquidator.counts_file_path)
+
+        with open(matrix_path, 'r') as matrix_file:
+           matrix_lines = [line.rstrip('\n').split('\t') for line in matrix_file.readlines()]
+           self.assertEqual(3, len(matrix_lines))
+
+           header_cols = matrix_lines[0]
+           self.assertEqual(['GENE_ID', 'locusLine'], header_cols[:2])
+           self.assertEqual(set(['bin_1_one_read.bam', 'bin_1_two_reads.bam']), set(header_cols[2:]))
+
+           # the two_reads.bam counts are halved by normalization since it has twice as many mapped reads
+           expected = {'bin_1_one_read.bam': '1000000.0', 'bin_1_two_reads.bam': '500000.0'}
+           self.assertEqual(['region_a', 'chr1(.):1-8'], matrix_lines[1][:2])
+           self.assertEqual(['region_b', 'chr1(.):11-30'], matrix_lines[2][:2])
+           for data_cols in matrix_lines[1:]:
+               self.assertEqual(4, len(data_cols))
+               for header, value in izip(header_cols[2:], data_cols[2:]):
+                   self.assertEqual(expected[header], value)
+
+    def test_region_matrix_rounding(self):
+        # counts are rounded like bamToGFF_turbo.py, with python's round, so halves are rounded away from zero
+        liquidator = self.liquidate_regions()
+
+        expected = {}
+        with tables.open_file(liquidator.counts_file_path, 'r+') as counts_file:
+            region_counts = counts_file.root.region_counts
+            region_counts.modify_column(column=[1.03125, 0.00005, 0.00025, 1000000.0], colname='normalized_count')
+            file_names = counts_file.root.file_names[:]
+            for row, expected_value in izip(region_counts, ['1.0313', '0.0001', '0.0003', '1000000.0']):
+                expected[(row['region_name'], 'bin_1_' + file_names[row['file_key']])] = expected_value
+
+        matrix_path = os.path.join(self.dir_path, 'matrix.gff')
+        blb.write_bamToGff_matrix(matrix_path, liquidator.counts_file_path)
+
+        with open(matrix_path, 'r') as matrix_file:
+           matrix_lines = [line.rstrip('\n').split('\t') for line in matrix_file.readlines()]
+           self.assertEqual(3, len(matrix_lines))
+
+           header_cols = matrix_lines[0]
+           for data_cols in matrix_lines[1:]:
+               for header, value in izip(header_cols[2:], data_cols[2:]):
+                   self.assertEqual(expected[(data_cols[0], header)], value)
+
+    def test_region_matrix_written_in_chunks(self):
+        liquidator = self.liquidate_regions()
+
+        matrix_path = os.path.join(self.dir_path, 'matrix.gff')
+        blb.write_bamToGff_matrix(matrix_path, liquidator.counts_file_path)
+        chunked_matrix_path = os.path.join(self.dir_path, 'chunked_matrix.gff')
+        blb.write_bamToGff_matrix(chunked_matrix_path, liquidator.counts_file_path, rows_per_write=1)
+
+        with open(matrix_path, 'r') as matrix_file:
+            with open(chunked_matrix_path, 'r') as chunked_matrix_file:
+                self.assertEqual(matrix_file.read(), chunked_matrix_file.read())
+
+class BamFilePathsInDirectoryTest(TempDirTest):
+    def setUp(self):
+        super(BamFilePathsInDirectoryTest, self).setUp()
+        for directory in ['a', os.path.join('a', 'b'), 'c']:
+            os.mkdir(os.path.join(self.dir_path, directory))
+        for file_name in ['top.bam', 'top.txt', os.path.join('a', 'x.bam'), os.path.join('a', 'b', 'y.bam'),
+                          os.path.join('c', 'z.bam')]:
+            open(os.path.join(self.dir_path, file_name), 'w').close()
+
+    def bam_file_paths_with_os_walk(self):
+        scandir = blb.scandir
+        blb.scandir = None
+        try:
+            return blb.all_bam_file_paths_in_directory(self.dir_path)
+        finally:
+            blb.scandir = scandir
+
+    @unittest.skipIf(blb.scandir is None, 'scandir is not installed')
+    def test_same_order_as_os_walk(self):
+        os.symlink(os.path.join(self.dir_path, 'a'), os.path.join(self.dir_path, 'c', 'link_to_a'))
+        bam_file_paths = blb.all_bam_file_paths_in_directory(self.dir_path)
+        self.assertEqual(self.bam_file_paths_with_os_walk(), bam_file_paths)
+        self.assertEqual(6, len(bam_file_paths))
+
+    @unittest.skipIf(blb.scandir is None, 'scandir is not installed')
+    def test_symbolic_link_loop(self):
+        # os.walk would follow these until the paths get too long
+        os.symlink(self.dir_path, os.path.join(self.dir_path, 'a', 'b', 'link_to_top'))
+        os.symlink('.', os.path.join(self.dir_path, 'c', 'link_to_self'))
+        bam_file_paths = blb.all_bam_file_paths_in_directory(self.dir_path)
+        self.assertEqual(sorted(os.path.join(self.dir_path, file_name) for file_name in
+                                ['top.bam', os.path.join('a', 'x.bam'), os.path.join('a', 'b', 'y.bam'),
+                                 os.path.join('c', 'z.bam')]),
+                         sorted(bam_file_paths))
+
+class CountsByRegionAndFileTest(unittest.TestCase):
+    def setUp(self):
+        # rows are interleaved by file, like regions liquidated concurrently and appended as each file finishes
+        self.file_key_column = numpy.array([2, 0, 0, 2, 5, 5, 0, 2, 5], dtype=numpy.uint32)
+        self.count_column = numpy.array([20, 0, 1, 21, 50, 51, 2, 22, 52], dtype=numpy.float64)
+        self.file_keys = [5, 0, 2]
+
+    def check_counts(self):
+        counts = blb.counts_by_region_and_file(self.file_key_column, self.count_column, self.file_keys, 3)
+        self.assertEqual([[50, 0, 20], [51, 1, 21], [52, 2, 22]], counts.tolist())
+        return counts
+
+    def check_errors(self):
+        with self.assertRaises(ValueError):
+            # a count is missing
+            blb.counts_by_region_and_file(self.file_key_column[:-1], self.count_column[:-1], self.file_keys, 3)
+        with self.assertRaises(ValueError):
+            # file key 7 is not in the files table
+            file_key_column = self.file_key_column.copy()
+            file_key_column[0] = 7
+            blb.counts_by_region_and_file(file_key_column, self.count_column, self.file_keys, 3)
+        with self.assertRaises(ValueError):
+            # file key 0 has one region too many and file key 2 one too few
+            file_key_column = self.file_key_column.copy()
+            file_key_column[0] = 0
+            blb.counts_by_region_and_file(file_key_column, self.count_column, self.file_keys, 3)
+
+    def check_without_numba(self, check):
+        njit = blb.njit
+        blb.njit = None
+        try:
+            return check()
+        finally:
+            blb.njit = njit
+
+    def test_counts(self):
+        self.check_counts()
+
+    def test_errors(self):
+        self.check_errors()
+
+    @unittest.skipIf(blb.njit is None, 'numba is not installed')
+    def test_numba_matches_numpy(self):
+        self.assertTrue(numpy.array_equal(self.check_without_numba(self.check_counts), self.check_counts()))
+        self.check_without_numba(self.check_errors)
 
 class LiquidateBamInDifferentDirectories(unittest.TestCase):
     def setUp(self):
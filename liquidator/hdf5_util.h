@@ -0,0 +1,39 @@
+#ifndef PIPELINE_BAMLIQUIDATORINTERNAL_HDF5_UTIL_H
+#define PIPELINE_BAMLIQUIDATORINTERNAL_HDF5_UTIL_H
+
+#include <hdf5.h>
+
+namespace liquidator
+{
+
+// Closes the hdf5 file when destroyed, so that the file is closed (and buffered changes flushed) on every return
+// and exception.
+class ScopedH5File
+{
+public:
+  // file is the id returned by H5Fopen, which may be negative if opening failed
+  explicit ScopedH5File(hid_t file) : file(file) {}
+
+  ~ScopedH5File()
+  {
+    if (file >= 0)
+    {
+      H5Fclose(file);
+    }
+  }
+
+  hid_t& get()
+  {
+    return file;
+  }
+
+private:
+  ScopedH5File(const ScopedH5File&) = delete;
+  ScopedH5File& operator=(const ScopedH5File&) = delete;
+
+  hid_t file;
+};
+
+}
+
+#endif
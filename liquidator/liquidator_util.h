@@ -2,6 +2,7 @@
 #define PIPELINE_BAMLIQUIDATORINTERNAL_BAMLIQUIDATOR_UTIL_H
 
 #include <algorithm>
+#include <fstream>
 #include <ostream>
 #include <sstream>
 #include <string>
@@ -142,10 +143,40 @@ private:
   mutable bool copied;
 };
 
+// The chromosome lengths are either argument pairs (chr1 length1 chr2 length2 ...) starting at chr1_arg,
+// or a single argument that is the path to a file with a tab separated chromosome and length on each line.
 inline std::vector<std::pair<std::string, size_t>>
 extract_chromosome_lengths(int argc, char* argv[], int chr1_arg)
 {
   std::vector<std::pair<std::string, size_t>> chromosome_lengths;
+  if (argc == chr1_arg + 1)
+  {
+    std::ifstream file(argv[chr1_arg]);
+    if (!file)
+    {
+      throw std::runtime_error(std::string("failed to open chromosome lengths file ") + argv[chr1_arg]);
+    }
+
+    std::string line;
+    while (std::getline(file, line))
+    {
+      std::istringstream line_stream(line);
+      std::string chromosome;
+      size_t length;
+      if (!(line_stream >> chromosome))
+      {
+        continue; // blank line
+      }
+      if (!(line_stream >> length))
+      {
+        throw std::runtime_error(std::string("failed to parse chromosome lengths file ") + argv[chr1_arg]
+                                 + " at line: " + line);
+      }
+      chromosome_lengths.push_back(std::make_pair(chromosome, length));
+    }
+    return chromosome_lengths;
+  }
+
   for (int arg = chr1_arg; arg < argc && arg + 1 < argc; arg += 2)
   {
     chromosome_lengths.push_back(
@@ -1,8 +1,12 @@
 #include "gtest/gtest.h"
 
+#include <cstdio>
+#include <fstream>
+
 #include "score_matrix.h"
 #include "detail/score_matrix_detail.h"
 #include "fimo_style_printer.h"
+#include "liquidator_util.h"
 
 using namespace liquidator;
 
@@ -473,6 +477,57 @@ TEST(ScoreMatrix, read_arguments)
     }
 }
 
+std::vector<std::pair<std::string, size_t>>
+chromosome_lengths_from_file(const std::string& contents)
+{
+    const std::string file_path = "test_chromosome_lengths.txt";
+    {
+        std::ofstream file(file_path);
+        file << contents;
+    }
+    std::string program = "test";
+    std::string argument = file_path;
+    char* argv[] = { &program[0], &argument[0] };
+    try
+    {
+        const auto chromosome_lengths = extract_chromosome_lengths(2, argv, 1);
+        std::remove(file_path.c_str());
+        return chromosome_lengths;
+    }
+    catch(...)
+    {
+        std::remove(file_path.c_str());
+        throw;
+    }
+}
+
+TEST(LiquidatorUtil, extract_chromosome_lengths_from_arguments)
+{
+    std::string program = "test", chr1 = "chr1", length1 = "100", chr2 = "chr2", length2 = "200";
+    char* argv[] = { &program[0], &chr1[0], &length1[0], &chr2[0], &length2[0] };
+    const std::vector<std::pair<std::string, size_t>> expected { {"chr1", 100}, {"chr2", 200} };
+    EXPECT_EQ(expected, extract_chromosome_lengths(5, argv, 1));
+}
+
+TEST(LiquidatorUtil, extract_chromosome_lengths_from_file)
+{
+    const std::vector<std::pair<std::string, size_t>> expected { {"chr1", 100}, {"chr2", 200} };
+    EXPECT_EQ(expected, chromosome_lengths_from_file("chr1\t100\nchr2\t200\n"));
+    EXPECT_EQ(expected, chromosome_lengths_from_file("chr1\t100\nchr2\t200"));
+    EXPECT_TRUE(chromosome_lengths_from_file("").empty());
+}
+
+TEST(LiquidatorUtil, extract_chromosome_lengths_from_file_errors)
+{
+    std::string program = "test";
+    std::string missing = "does_not_exist/test_chromosome_lengths.txt";
+    char* argv[] = { &program[0], &missing[0] };
+    EXPECT_THROW(extract_chromosome_lengths(2, argv, 1), std::runtime_error);
+
+    EXPECT_THROW(chromosome_lengths_from_file("chr1\tabc\n"), std::runtime_error);
+    EXPECT_THROW(chromosome_lengths_from_file("chr1\t100\nchr2\n"), std::runtime_error);
+}
+
 std::string fimo_style_line(const ScoreMatrix& matrix, const std::string& sequence)
 {
     std::stringstream ss;